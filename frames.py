@@ -0,0 +1,149 @@
+#!/usr/bin/python3
+
+""" Pure IC7100 CI-V frame building and decoding.  Nothing here touches
+    the serial port, so frames can be built offline and sent in a batch.
+"""
+
+from functools import lru_cache
+
+## Set some IC7100 communication defaults
+PREAMBLE = [0xfe,0xfe]
+TRANSCEIVER_ADDR = [0x88]
+CONTROLLER_ADDR = [0xe0]
+EOM = [0xfd]
+## the frame header and EOM never change, build them once
+_BASE = bytes(PREAMBLE + TRANSCEIVER_ADDR + CONTROLLER_ADDR)
+_EOM = bytes(EOM)
+
+## number of preamble bytes to wake the radio at each baud rate
+PREAMBLE_RPTS = {19200:25,
+                 9600:13,
+                 4800:17,
+                 1200:3,
+                 300:2}
+## special memory channels
+SPECIAL_CHANNELS = {'1A':b'\x01\x00',
+                    '1B':b'\x01\x01',
+                    '2A':b'\x01\x02',
+                    '2B':b'\x01\x03',
+                    '3A':b'\x01\x04',
+                    '3B':b'\x01\x05',
+                    '144-C1':b'\x01\x06',
+                    '144-C2':b'\x01\x07',
+                    '430-C1':b'\x01\x08',
+                    '430-C2':b'\x01\x09'}
+## memory bank codes
+MEM_BANKS = {'A':0x01,'B':0x02,'C':0x03,'D':0x04,'E':0x05}
+## operating mode codes
+OP_MODES = {'LSB':0x00,
+            'USB':0x01,
+            'AM':0x02,
+            'CW':0x03,
+            'RTTY':0x04,
+            'FM':0x05,
+            'WFM':0x06,
+            'CW-R':0x07,
+            'RTTY-R':0x08,
+            'DV':0x17}
+## VFO codes
+VFOS = {'A':0x00,'B':0x01}
+
+## bcd <-> decimal lookup tables, one bcd byte holds 0 - 99
+BCD2DEC = bytes(((b >> 4) & 0xf) * 10 + (b & 0xf) for b in range(256))
+DEC2BCD = bytes(((d // 10) << 4) | (d % 10) for d in range(100))
+
+def build_command(cmd, subcmd=None, data=None):
+    """ Build the command to pass to the radio
+        PARAMETERS:
+                  cmd: the hex command to send
+                  subcmd: the hex subcommand to send, if required
+                  data: the data in hex to send, if required
+         RETURNS:
+                ncmd: bytes of the cmd to send
+    """
+
+    return b''.join((_BASE, bytes(cmd),
+                     bytes(subcmd or b''), bytes(data or b''),
+                     _EOM))
+
+def build_on(baud):
+    """ Build the power on command, the preamble is repeated per baud rate  """
+    return _BASE[:1] * PREAMBLE_RPTS[baud] + build_command([0x18], [0x01])
+
+def build_off():
+    """ Build the power off command  """
+    return build_command([0x18], [0x00])
+
+def build_vfo(c):
+    """ Build the VFO select command for VFO A or B  """
+    return build_command([0x07], [VFOS[c.upper()]])
+
+def build_memory():
+    """ Build the Memory mode select command  """
+    return build_command([0x08])
+
+def build_membank(b):
+    """ Build the Memory Bank select command for bank A - E  """
+    return build_command([0x08], [0xa0], [MEM_BANKS[b.upper()]])
+
+@lru_cache(maxsize=256, typed=True)
+def build_channel(c):
+    """ Build (and cache) the Memory Channel select command
+        PARAMETERS:
+                   str or int c: channel 0 - 99, or a special channel name
+    """
+    if isinstance(c, bool):
+        raise TypeError("Channel must be an integer or String, got %r" % c)
+    if isinstance(c, int):
+        if not 0 <= c <= 99:
+            raise ValueError("Channel must be 0 - 99, got %d" % c)
+        return build_command([0x08], DEC2BCD[c:c+1])
+    return build_command([0x08], SPECIAL_CHANNELS[c.upper()])
+
+def build_readfreq():
+    """ Build the read operating frequency command  """
+    return build_command([0x03])
+
+def build_setfreq(hz):
+    """ Build the set operating frequency command
+        PARAMETERS:
+                   int hz: the frequency in Hz
+    """
+    if not 0 <= hz < 10**10:
+        raise ValueError("Frequency must be 0 - 9999999999 Hz, got %d" % hz)
+    ## 5 bytes of 2 digits each, lowest digits first (same order as decode_freq)
+    data = bytes(DEC2BCD[(hz // 10**i) % 100] for i in (0, 2, 4, 6, 8))
+    return build_command([0x00], data=data)
+
+def build_readmode():
+    """ Build the read operating mode command  """
+    return build_command([0x04])
+
+def build_setmode(mode):
+    """ Build the set operating mode command  """
+    return build_command([0x06], data=[OP_MODES[mode.upper()]])
+
+def build_rx():
+    """ Build the set to receive command  """
+    return build_command([0x1C], [0x00], [0x00])
+
+def build_tx():
+    """ Build the set to transmit command  """
+    return build_command([0x1C], [0x00], [0x01])
+
+def decode_freq(resp):
+    """ Decode the frequency in Hz from a read frequency response
+        5 bcd bytes after the 5 byte header, lowest digits first
+        10hz,1hz  1khz,100hz  100khz,10khz  10mhz,1mhz  1ghz,100mhz
+    """
+    return (BCD2DEC[resp[5]] +
+            BCD2DEC[resp[6]] * 100 +
+            BCD2DEC[resp[7]] * 10000 +
+            BCD2DEC[resp[8]] * 1000000 +
+            BCD2DEC[resp[9]] * 100000000)
+
+def format_freq(hz):
+    """ Format the frequency in Hz to match XXX.XXX.xx  """
+    mhz, r = divmod(hz, 1000000)
+    khz, hz = divmod(r, 1000)
+    return '%03d.%03d.%02d' % (mhz, khz, hz // 10)
@@ -3,7 +3,7 @@
 import os
 import sys
 import serial
-import numpy as np
+import frames
 
 class Radio():
 
@@ -14,6 +14,7 @@ class Radio():
         self._transmitting = False
         self._baudrate = 19200
         self._port = '/dev/ttyUSB0'
+        self._timeout = 1.0
         self._serial = None
 
     def setBaud(self, baud):
@@ -22,6 +23,9 @@ class Radio():
     def setPort(self, port):
         self._port = port
 
+    def setTimeout(self, timeout):
+        self._timeout = timeout
+
     def connect(self):
 
         """ Base function to connect serial device  """
@@ -29,7 +33,29 @@ class Radio():
         if self._serial is not None:
             self.disconnect()
 
-        self._serial = serial.Serial(self._port, baudrate=self._baudrate)
+        self._serial = serial.Serial(self._port, baudrate=self._baudrate,
+                                     timeout=self._timeout,
+                                     inter_byte_timeout=None)
+        self.setLatencyTimer()
+        ## ask the driver for low latency mode (linux only), not all ports support it
+        try:
+            self._serial.set_low_latency_mode(True)
+        except (AttributeError, ValueError, OSError):
+            pass
+
+    def setLatencyTimer(self, msec=1):
+        """ Lower the FTDI latency timer (default 16ms) on Linux.
+            Needs write access to sysfs, silently ignored otherwise.
+            PARAMETERS:
+                       int msec: the latency timer in milliseconds
+        """
+        dev = os.path.basename(os.path.realpath(self._port))
+        path = '/sys/bus/usb-serial/devices/%s/latency_timer' % dev
+        try:
+            with open(path, 'w') as f:
+                f.write(str(msec))
+        except OSError:
+            pass
 
     def disconnect(self):
 
@@ -43,25 +69,46 @@ class Radio():
     def sendCmd(self,cmd):
         """ Send the command, plus and subcommands and/or data to the radio """
 
-        ## TODO: Can we use struct here?
-        for c in cmd:
-            self._serial.write(bytes([c]))
+        ## write the whole frame at once, one write per byte is slow on usb serial
+        if not isinstance(cmd, (bytes, bytearray)):
+            cmd = bytes(cmd)
+        self._serial.write(cmd)
         resp = self.readResponse()
-        if resp != cmd:
+        if bytes(resp) != cmd:
             print("Error: Initial response does not match command!\n")
 
+    def _txn(self, cmd, timeout=None):
+        """ Send the command and read the radio's reply in one step.
+            Connects first if the port is not open yet.
+            PARAMETERS:
+                       cmd: the command to send
+                       float timeout: read timeout for this command only,
+                                      the port timeout if None
+            RETURNS:
+                    the reply frame that follows the command echo
+        """
+        if self._serial is None:
+            self.connect()
+        ## drop any late reply left from an earlier timed out command
+        self._serial.reset_input_buffer()
+        if timeout is None:
+            self.sendCmd(cmd)
+            return self.readResponse()
+        self._serial.timeout = timeout
+        try:
+            self.sendCmd(cmd)
+            return self.readResponse()
+        finally:
+            self._serial.timeout = self._timeout
+
     def readResponse(self):
         """ Read the response from the radio  
             MUST READ TWICE TO GET RESPONSE.  First
             response is a copy of the command sent 
         """
-        c = 0
-        reply = []
-        while c != 0xfd:
-            d = self._serial.read(1)
-            if (len(d) > 0):
-                c = d[0]
-            reply.append(c)
+        reply = self._serial.read_until(b'\xfd')
+        if len(reply) == 0 or reply[-1] != 0xfd:
+            print("Error: Timed out waiting for response")
 
         if len(reply) == 6:
             if reply[4] == 0xfb:
@@ -77,23 +124,11 @@ class Radio():
 
     def convert_from_bcd(self, bcd):
         """ convert the response bcd data to integer  """
-        place, decimal = 1, 0
-        while bcd > 0:
-            nibble = bcd & 0xf
-            decimal += nibble * place
-            bcd >>= 4
-            place *= 10
-        return decimal
+        return frames.BCD2DEC[bcd]
 
     def convert_to_bcd(self, decimal):
         """ convert the decimal to bcd  """
-        place, bcd = 0, 0
-        while decimal > 0:
-            nibble = int(decimal % 10)
-            bcd += nibble << place
-            decimal /= 10
-            place += 4
-        return bcd
+        return frames.DEC2BCD[decimal]
 
 class Icom7100(Radio):
 
@@ -101,10 +136,16 @@ class Icom7100(Radio):
         radio functionality for use through a serial port.
     """
     ## Set some IC7100 communication defaults
-    PREAMBLE = [0xfe,0xfe]
-    TRANSCEIVER_ADDR = [0x88]
-    CONTROLLER_ADDR = [0xe0]
-    EOM = [0xfd]
+    PREAMBLE = frames.PREAMBLE
+    TRANSCEIVER_ADDR = frames.TRANSCEIVER_ADDR
+    CONTROLLER_ADDR = frames.CONTROLLER_ADDR
+    EOM = frames.EOM
+    PREAMBLE_RPTS = frames.PREAMBLE_RPTS
+    SPECIAL_CHANNELS = frames.SPECIAL_CHANNELS
+    MEM_BANKS = frames.MEM_BANKS
+    OP_MODES = frames.OP_MODES
+    ## the power on ACK only comes once the radio is up, wait longer for it
+    ON_TIMEOUT = 5.0
 
     def __init__(self):
         super().__init__()
@@ -113,51 +154,81 @@ class Icom7100(Radio):
         self._baudrate = 19200
         self._port = '/dev/ttyUSB0'
 
-    def buildCommand(self,cmd, subcmd=None, data=None):
+        ## commands without variable data are the same every call, build them once
+        self._CMD_ON = {baud:frames.build_on(baud) for baud in self.PREAMBLE_RPTS}
+        self._CMD_OFF = frames.build_off()
+        self._CMD_SELMEM = frames.build_memory()
+        self._CMD_RDFREQ = frames.build_readfreq()
+        self._CMD_RDMODE = frames.build_readmode()
+        self._CMD_RX = frames.build_rx()
+        self._CMD_TX = frames.build_tx()
+        self._CMD_VFO = {c:frames.build_vfo(c) for c in frames.VFOS}
+        self._CMD_MEMBANK = {b:frames.build_membank(b) for b in self.MEM_BANKS}
+        self._CMD_MODE = {m:frames.build_setmode(m) for m in self.OP_MODES}
+
+    def setBaud(self, baud):
+        """ Set the baud rate, must be one the IC7100 supports  """
+        if baud not in self.PREAMBLE_RPTS:
+            raise ValueError("Unsupported baud rate %r.  Must be one of %s"
+                             % (baud, sorted(self.PREAMBLE_RPTS)))
+        super().setBaud(baud)
+
+    @staticmethod
+    def buildCommand(cmd, subcmd=None, data=None):
         """ Build the command to pass to the radio
             PARAMETERS:
                       cmd: the hex command to send
                       subcmd: the hex subcommand to send, if required
                       data: the data in hex to send, if required
              RETURNS:
-                    ncmd: list of cmd values to send
+                    ncmd: bytes of the cmd to send
         """
 
-        ## TODO: Change to use struct
-        base_cmd = self.PREAMBLE + self.TRANSCEIVER_ADDR + self.CONTROLLER_ADDR 
-        ncmd = base_cmd + cmd
-        if subcmd is not None:
-            ncmd += subcmd
-        if data is not None:
-            ncmd += data
-        ncmd += self.EOM
-        return ncmd
+        return frames.build_command(cmd, subcmd, data)
+
+    def sendBatch(self, cmds):
+        """ Send several prebuilt commands in a single write, then read
+            back all the echoes and replies.  The radio can echo every
+            command before it replies, so frames are sorted by their
+            destination address rather than read in pairs.
+            PARAMETERS:
+                       list cmds: the command frames (bytes) to send
+            RETURNS:
+                    list of the reply frames, in command order
+        """
+        if self._serial is None:
+            self.connect()
+        self._serial.reset_input_buffer()
+        self._serial.write(b''.join(cmds))
+        echoes = []
+        replies = []
+        ## frames for other addresses (e.g. transceive broadcasts) are skipped,
+        ## so read until every echo and reply is in or a read times out
+        while len(echoes) < len(cmds) or len(replies) < len(cmds):
+            frame = self.readResponse()
+            if len(frame) == 0 or frame[-1] != 0xfd:
+                break
+            ## skip the preamble, the next byte is the destination address
+            dest = bytes(frame).lstrip(b'\xfe')[:1]
+            if dest == bytes(self.TRANSCEIVER_ADDR):
+                echoes.append(frame)
+            elif dest == bytes(self.CONTROLLER_ADDR):
+                replies.append(frame)
+        if [bytes(e) for e in echoes] != [bytes(c) for c in cmds]:
+            print("Error: Initial response does not match command!\n")
+        if len(replies) != len(cmds):
+            print("Error: Expected %d replies, got %d" % (len(cmds), len(replies)))
+        return replies
 
     def turnOn(self):
         """ Turn on the IC7100 Radio.  Command adjusted to baud rate """
 
-        preamble_rpts = {19200:25,
-                         9600:13,
-                         4800:17,
-                         1200:3,
-                         300:2}
-        on_prefix = [self.PREAMBLE[0]] * preamble_rpts[self._baudrate]
-        cmd = [0x18]
-        subcmd = [0x01]
-        on_cmd = on_prefix + self.buildCommand(cmd,subcmd) 
-        self.sendCmd(on_cmd)
-        ## clear the response
-        self.readResponse()
+        self._txn(self._CMD_ON[self._baudrate], timeout=self.ON_TIMEOUT)
 
     def turnOff(self):
         """ Turn off the IC7100 radio. """
 
-        cmd = [0x18]
-        subcmd = [0x00]
-        off_cmd = self.buildCommand(cmd, subcmd)
-        self.sendCmd(off_cmd)
-        ## clear the response
-        self.readResponse()
+        self._txn(self._CMD_OFF)
 
     def selectVFO(self, c='A'):
         """ Select the VFO mode.
@@ -165,29 +236,16 @@ class Icom7100(Radio):
                         str c: The VFO to select, A or B
         """
 
-        cmd = [0x07]
-        subcmd = None
-        if c.upper() == 'A':
-            subcmd = [0x00]
-        elif c.upper() == 'B':
-            subcmd = [0x01]
-
-        if subcmd is not None:
-            ncmd = self.buildCommand(cmd,subcmd)
-            self.sendCmd(ncmd)
-            ## clear the response
-            self.readResponse()
+        ncmd = self._CMD_VFO.get(c.upper())
+        if ncmd is not None:
+            self._txn(ncmd)
         else:
             print("Error: Incorrect channel provided.  Must provide A or B")
 
     def selectMemory(self):
         """ Select the Memory mode.  """
 
-        cmd = [0x08]
-        ncmd = self.buildCommand(cmd)
-        self.sendCmd(ncmd)
-        ## clear the response
-        self.readResponse()
+        self._txn(self._CMD_SELMEM)
 
     def selectMemBank(self, b='A'):
         """ select the Memory Bank.
@@ -195,14 +253,11 @@ class Icom7100(Radio):
                         str b: the Memory Bank to select, A, B, C, D, or E
         """
 
-        cmd = [0x08]
-        subcmd = [0xa0]
-        mem_banks = {'A':0x01,'B':0x02,'C':0x03,'D':0x04,'E':0x05}
-        data = [mem_banks[b.upper()]]
-        ncmd = self.buildCommand(cmd, subcmd, data)
-        self.sendCmd(ncmd)
-        ## clear the response
-        self.readResponse()
+        try:
+            ncmd = self._CMD_MEMBANK[b.upper()]
+        except KeyError:
+            raise KeyError("Unknown memory bank %r.  Must provide A, B, C, D, or E" % b) from None
+        self._txn(ncmd)
 
     def selectMemChannel(self,c=None):
         """ Select the channel in the selected Memory Bank
@@ -212,132 +267,70 @@ class Icom7100(Radio):
                        str or int c: the channel as a string or int
                                      need both to handle special channels
         """
-        chan_dict = {'1A':[0x01, 0x00],
-                     '1B':[0x01, 0x01],
-                     '2A':[0x01, 0x02],
-                     '2B':[0x01, 0x03],
-                     '3A':[0x01, 0x04],
-                     '3B':[0x01, 0x05],
-                     '144-C1':[0x01, 0x06],
-                     '144-C2':[0x01, 0x07],
-                     '430-C1':[0x01, 0x08],
-                     '430-C2':[0x01, 0x09]}
-        ichannel = None
-        cmd = [0x08]
-        if c is not None:
-            if type(c) != int and type(c) != str:
-                print("Error: Channel must be an integer or String")
-            else:
-                if type(c) == int and c <= 99:
-                    channel = '0x%s' %str(c)
-                    ichannel = [int(channel,0)]
-                elif type(c) == str:
-                    if c.upper() not in chan_dict.keys():
-                        print("Error: Unexpected String received")
-                    else:
-                        ichannel = chan_dict[c.upper()]
-        if ichannel is not None:
-            ncmd = self.buildCommand(cmd, ichannel) #self.PREAMBLE + self.TRANSCEIVER_ADDR + self.CONTROLLER_ADDR + cmd + ichannel + self.EOM
-            self.sendCmd(ncmd)
-            ## clear the response
-            self.readResponse()
-        else:
+        ncmd = None
+        if c is None:
             print("Error: No Channel Provided")
+        elif isinstance(c, bool) or not isinstance(c, (int, str)):
+            print("Error: Channel must be an integer or String")
+        else:
+            try:
+                ncmd = frames.build_channel(c)
+            except ValueError:
+                print("Error: Channel must be 0 - 99")
+            except KeyError:
+                print("Error: Unexpected String received")
+        if ncmd is not None:
+            self._txn(ncmd)
 
     def readOpFreq(self):
-        """ Read the current frequency from the radio  """
-        cmd = [0x03]
-        ncmd = self.buildCommand(cmd) #self.PREAMBLE + self.TRANSCEIVER_ADDR + self.CONTROLLER_ADDR + cmd + self.EOM
-        self.sendCmd(ncmd)
+        """ Read the current frequency from the radio
+            RETURNS:
+                    sfreq: the frequency as a string, XXX.XXX.xx
+        """
         ## read the frequency data message
-        resp = self.readResponse()
+        resp = self._txn(self._CMD_RDFREQ)
+        if len(resp) < 11 or resp[-1] != 0xfd:
+            print("Error: Incomplete frequency response")
+            return None
         ## convert bcd response to readable frequency
         ## documentation says 5 values in response represent the frequency
         ## first 6 are message sent, last 1 is EOM
-        ## freq response is not in correct order
-        ## 1          2          3            4          5
-        ## 10hz, 1hz  1khz,100hz 100khz,10khz 10mhz,1mhz 1ghz,100mhz  -- 1ghz is always 0
-
-        freqs = []
-        for i in range(9,4,-1):
-            freqs.append(self.convert_from_bcd(resp[i]))
-        freq_c = np.array([1e7,1e5,1e3,10,1])
-        print(freqs)
-        freq = np.array(freqs)
-        freq = np.sum(freq*freq_c)
-        print(freq)
-        ## TODO: format freq to match XXX.XXX.xx
+        sfreq = frames.format_freq(frames.decode_freq(resp))
+        print(sfreq)
+        return sfreq
 
     def setOpFreq(self,freq):
         """ Set the operating frequency  
             PARAMETERS: 
                        freq: the frequency in MHz
         """
-        cmd = [0x00]
-        ## Freq needs to be written into the bcd format
-        ## first, convert to string  and zfill
-        nfreq = str(freq).zfill(8)
-        ## now split the string into the correct order for bcd
-        tarr = [nfreq[-1],nfreq[-3:-1],nfreq[-5:-3],nfreq[-7:-5],nfreq[0]]
-        data = []
-        ## convert to bcd
-        for i in range(len(tarr)):
-            data.append(self.convert_to_bcd(int(tarr[i])))
-        ncmd = self.buildCommand(cmd, data=data)
-        self.sendCmd(ncmd)
+        self._txn(frames.build_setfreq(int(round(freq * 1000000))))
 
     def readOpMode(self):
         """ Read the current Operating Mode  """
-        cmd = [0x04]
-        ncmd = self.buildCommand(cmd)
-        self.sendCmd(ncmd)
         ## read the op mode response
-        resp = self.readResponse()
+        resp = self._txn(self._CMD_RDMODE)
+        if len(resp) < 8 or resp[-1] != 0xfd:
+            print("Error: Incomplete operating mode response")
+            return
         ## first response is the operating mode, 2nd is filter
         ## 00:LSB 01:USB 02:AM 03:CW 04:RTTY 05: FM 06: WFM 07:CWR 08:RTTY-R 17:DV
         ## 01:Filt1 02:Filt2 03:Filt3
-        op_mode = self.convert_from_bcd(resp[5])
-        filt = self.convert_from_bcd(resp[6])
+        op_mode = frames.BCD2DEC[resp[5]]
+        filt = frames.BCD2DEC[resp[6]]
         print(resp)
         print(op_mode)
         print(filt)
 
     def setOpMode(self,mode=None):
         """ Set the Operating Mode  """
-        mode_dict = {'LSB':[0x00],
-                     'USB':[0x01],
-                     'AM':[0x02],
-                     'CW':[0x03],
-                     'RTTY':[0x04],
-                     'FM':[0x05],
-                     'WFM':[0x06],
-                     'CW-R':[0x07],
-                     'RTTY-R':[0x08],
-                     'DV':[0x17]}
-        cmd = [0x06]
-        if mode is not None and mode.upper() in mode_dict:
-            data = mode_dict[mode]
-            ncmd = self.buildCommand(cmd,data=data)
-            self.sendCmd(ncmd)
-            ## clear the response
-            self.readResponse()
+        if mode is not None and mode.upper() in self._CMD_MODE:
+            self._txn(self._CMD_MODE[mode.upper()])
 
     def setRx(self):
         """ set the transceiver to receive  """
-        cmd = [0x1C]
-        subcmd = [0x00]
-        data = [0x00]
-        ncmd = self.buildCommand(cmd, subcmd, data)
-        self.sendCmd(ncmd)
-        ## clear the response
-        self.readResponse()
+        self._txn(self._CMD_RX)
 
     def setTx(self):
         """ set the transceiver to transmit  """
-        cmd = [0x1C]
-        subcmd = [0x00]
-        data = [0x01]
-        ncmd = self.buildCommand(cmd, subcmd, data)
-        self.sendCmd(ncmd)
-        ## clear the response
-        self.readResponse()
+        self._txn(self._CMD_TX)